@@ -0,0 +1,61 @@
+'''Production build: precompile the firmware to .mpy for a fast boot.
+
+    pip install mpy-cross==1.22.2
+    python build.py [--manifest]
+
+Writes build/ with sim800.mpy, umqtt.mpy, scheduler.mpy, app.mpy (compiled
+from main.py) and a two line main.py that imports app, plus SHA256SUMS so
+two builds can be compared. Copy those five files to the board. --manifest also
+writes build/manifest.py to freeze the same modules into the firmware
+image instead.
+'''
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+
+MPY_CROSS_VERSION = '1.22.2'
+MODULES = {'sim800.py': 'sim800', 'umqtt.py': 'umqtt', 'scheduler.py': 'scheduler', 'main.py': 'app'}
+STRIPPED = ('sim800.py',)  # -O1 drops the `if __debug__:` AT tracing blocks
+BUILD = 'build'
+STUB = 'import app\napp.main()\n'
+
+
+def mpy_cross(*args):
+    return subprocess.run(('mpy-cross',) + args, check=True, capture_output=True, text=True).stdout
+
+
+def check_version():
+    version = mpy_cross('--version')
+    if MPY_CROSS_VERSION not in version:
+        sys.exit(f'mpy-cross {MPY_CROSS_VERSION} required, found: {version.strip()}')
+
+
+def build(manifest=False):
+    check_version()
+    shutil.rmtree(BUILD, ignore_errors=True)
+    os.makedirs(BUILD)
+    for src, name in sorted(MODULES.items()):
+        opt = '-O1' if src in STRIPPED else '-O0'
+        mpy_cross(opt, '-s', name + '.py', '-o', os.path.join(BUILD, name + '.mpy'), src)
+    with open(os.path.join(BUILD, 'main.py'), 'w') as f:
+        f.write(STUB)
+    if manifest:
+        frozen = os.path.join(BUILD, 'frozen')
+        os.makedirs(frozen)
+        with open(os.path.join(BUILD, 'manifest.py'), 'w') as f:
+            f.write('include("$(PORT_DIR)/boards/manifest.py")\n')
+            for src, name in sorted(MODULES.items()):
+                shutil.copyfile(src, os.path.join(frozen, name + '.py'))
+                f.write(f'module("{name}.py", base_path="{os.path.abspath(frozen)}")\n')
+    sums = []
+    for name in sorted(n for n in os.listdir(BUILD) if n.endswith(('.mpy', '.py'))):
+        with open(os.path.join(BUILD, name), 'rb') as f:
+            sums.append(f'{hashlib.sha256(f.read()).hexdigest()}  {name}\n')
+    with open(os.path.join(BUILD, 'SHA256SUMS'), 'w') as f:
+        f.writelines(sums)
+
+
+if __name__ == "__main__":
+    build(manifest='--manifest' in sys.argv[1:])
@@ -0,0 +1,366 @@
+'''Fleet load generator for the telemetry broker, runs under CPython.
+
+    python loadgen.py --devices 2000 --duration 600 --speed 10 --host localhost
+
+Every simulated pump drives the real umqtt.MQTTClient through a socket shim
+that adds GPRS latency, bandwidth and loss. A wake mirrors main.py: connect
+with clean_session=False under the device's own client id, publish every
+reading to telemetry/pump/* with QoS1, then drop the link without a
+DISCONNECT, as deep sleep does. Devices wake every 5 min, or every 4 min
+while pumping. --speed compresses the schedule, not the link.
+
+--tls runs the handshake over memory BIOs so its bytes and round trips go
+through the same link and are reported. --resume keeps each device's TLS
+session across wakes, --psk IDENTITY:HEXKEY uses a PSK cipher instead of
+certificates (Python 3.13 or later).
+'''
+import argparse
+import binascii
+import heapq
+import random
+import socket
+import ssl
+import struct
+import sys
+import threading
+import time
+import types
+
+# umqtt imports the MicroPython module names, its sockets go over the
+# simulated link and are kept per thread so a wake can count its bytes
+local = threading.local()
+usocket = types.ModuleType('usocket')
+usocket.getaddrinfo = socket.getaddrinfo
+usocket.socket = lambda *args: local.sock
+sys.modules['usocket'] = usocket
+sys.modules['ustruct'] = struct
+sys.modules['ubinascii'] = binascii
+
+from umqtt import MQTTClient, MQTTException  # noqa: E402
+
+READINGS = ('battery', 'temp', 'soil', 'rain', 'relay', 'rssi', 'link')
+
+
+class Link:
+    def __init__(self, latency_ms=600, jitter_ms=200, loss=0.02, bandwidth=4000, rto_ms=1000):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.loss = loss
+        self.bandwidth = bandwidth  # bytes/s
+        self.rto = rto_ms / 1000
+
+    def one_way(self, size):
+        # A lost segment is resent after RTO with exponential backoff like TCP
+        delay = max(random.gauss(self.latency, self.jitter), 0) + size / self.bandwidth
+        rto = self.rto
+        while random.random() < self.loss:
+            delay += rto
+            rto *= 2
+        return delay
+
+    def round_trip(self, size):
+        time.sleep(self.one_way(size) + self.one_way(4))
+
+
+class GprsSocket:
+    # Just enough of the MicroPython socket API for umqtt
+    def __init__(self, link):
+        self.link = link
+        self.sock = socket.socket()
+        self.sent = 0
+        self.received = 0
+        self.pending = 0
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def setblocking(self, flag):
+        self.sock.setblocking(flag)
+
+    def connect(self, addr):
+        self.link.round_trip(60)
+        self.sock.connect(addr)
+
+    def write(self, buf, n=None):
+        if isinstance(buf, str):
+            buf = buf.encode()
+        data = bytes(buf if n is None else buf[:n])
+        self.sock.sendall(data)
+        self.sent += len(data)
+        self.pending += len(data)
+        return len(data)
+
+    def _wait(self):
+        if self.pending:
+            # writes are pipelined, the wait for a reply costs one round trip
+            self.link.round_trip(self.pending)
+            self.pending = 0
+
+    def recv(self, n):
+        self._wait()
+        data = self.sock.recv(n)
+        self.received += len(data)
+        return data
+
+    def read(self, n):
+        self._wait()
+        data = b''
+        while len(data) < n:
+            try:
+                chunk = self.sock.recv(n - len(data))
+            except BlockingIOError:
+                return data or None
+            if not chunk:
+                break
+            data += chunk
+        self.received += len(data)
+        return data
+
+    def close(self):
+        self.sock.close()
+
+
+class TlsSocket:
+    # The same API over an SSLObject, the TLS records go through GprsSocket
+    def __init__(self, raw, context, session=None, server_hostname=None):
+        self.raw = raw
+        self.incoming = ssl.MemoryBIO()
+        self.outgoing = ssl.MemoryBIO()
+        self.obj = context.wrap_bio(self.incoming, self.outgoing,
+                                    server_hostname=server_hostname, session=session)
+        start = time.monotonic()
+        self._call(self.obj.do_handshake)
+        self.handshake_time = time.monotonic() - start
+        self.handshake_bytes = raw.sent + raw.received
+
+    @property
+    def session(self):
+        return self.obj.session
+
+    def _flush(self):
+        data = self.outgoing.read()
+        if data:
+            self.raw.write(data)
+
+    def _call(self, fn, *args):
+        while True:
+            try:
+                res = fn(*args)
+            except ssl.SSLWantReadError:
+                self._flush()
+                data = self.raw.recv(4096)
+                if not data:
+                    raise OSError(-1)
+                self.incoming.write(data)
+            else:
+                self._flush()
+                return res
+
+    def settimeout(self, timeout):
+        self.raw.settimeout(timeout)
+
+    def setblocking(self, flag):
+        self.raw.setblocking(flag)
+
+    def write(self, buf, n=None):
+        if isinstance(buf, str):
+            buf = buf.encode()
+        data = bytes(buf if n is None else buf[:n])
+        self._call(self.obj.write, data)
+        return len(data)
+
+    def read(self, n):
+        data = b''
+        while len(data) < n:
+            chunk = self._call(self.obj.read, n - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def close(self):
+        self.raw.close()
+
+
+class TlsContext:
+    # What umqtt expects from an SSLContext
+    def __init__(self, context):
+        self.context = context
+
+    def wrap_socket(self, sock, session=None, server_hostname=None):
+        return TlsSocket(sock, self.context, session, server_hostname)
+
+
+def tls_context(args):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    if args.tls12:
+        context.maximum_version = ssl.TLSVersion.TLSv1_2
+    if args.psk:
+        if not hasattr(context, 'set_psk_client_callback'):
+            sys.exit('--psk needs Python 3.13 or later')
+        identity, key = args.psk.split(':', 1)
+        key = bytes.fromhex(key)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        context.set_ciphers('PSK')
+        context.set_psk_client_callback(lambda hint: (identity, key))
+    elif args.cafile:
+        context.load_verify_locations(args.cafile)
+    else:
+        context.load_default_certs()
+    return TlsContext(context)
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.puback = []
+        self.connect = []
+        self.lag = []
+        self.handshake = []
+        self.handshake_bytes = []
+        self.resumed = 0
+        self.published = 0
+        self.failed_wakes = 0
+        self.wakes = 0
+        self.bytes = 0
+
+    def add(self, name, value):
+        with self.lock:
+            getattr(self, name).append(value)
+
+
+def percentiles(values, points=(50, 90, 99)):
+    if not values:
+        return 'n/a'
+    values = sorted(values)
+    res = [f'p{p}={values[min(len(values) - 1, len(values) * p // 100)] * 1000:.0f}' for p in points]
+    return ' '.join(res) + f' max={values[-1] * 1000:.0f} ms'
+
+
+def reading(key):
+    if key == 'battery':
+        return f'{random.uniform(11.6, 13.4):.2f}'
+    if key == 'temp':
+        return f'{random.uniform(5, 30):.2f}'
+    if key in ('soil', 'rain'):
+        return f'{random.uniform(0, 100):.2f}'
+    if key == 'rssi':
+        return f'{random.uniform(0.2, 0.9):.2f}'
+    if key == 'link':
+        return 'online'
+    return random.choice('01')
+
+
+def wake(device, args, link, stats, sessions):
+    sock = local.sock = GprsSocket(link)
+    client = MQTTClient(f'pump-{device:05d}', args.host, port=args.port, ssl=args.context,
+                        ssl_params={'server_hostname': args.host} if args.context else {})
+    client.ssl_session = sessions.get(device)
+    try:
+        start = time.monotonic()
+        client.connect(clean_session=False)
+        stats.add('connect', time.monotonic() - start)
+        if args.context:
+            stats.add('handshake', client.sock.handshake_time)
+            stats.add('handshake_bytes', client.sock.handshake_bytes)
+            if client.sock.obj.session_reused:
+                with stats.lock:
+                    stats.resumed += 1
+        for key in READINGS:
+            start = time.monotonic()
+            client.publish(f'{args.topic}/{key}', reading(key), qos=1)
+            stats.add('puback', time.monotonic() - start)
+            with stats.lock:
+                stats.published += 1
+        if args.resume and args.context:
+            sessions[device] = client.ssl_session
+    except (OSError, AssertionError, IndexError, MQTTException, ssl.SSLError):
+        with stats.lock:
+            stats.failed_wakes += 1
+    finally:
+        sock.close()
+        with stats.lock:
+            stats.wakes += 1
+            stats.bytes += sock.sent + sock.received
+
+
+def run(args):
+    link = Link(args.latency, args.jitter, args.loss, args.bandwidth)
+    stats = Stats()
+    sessions = {}
+    args.context = tls_context(args) if args.tls or args.psk else False
+    pumping = set(random.sample(range(args.devices), int(args.devices * args.pumping)))
+    start = time.monotonic()
+    end = start + args.duration
+    # (due, device), every device starts at a random phase of its interval
+    schedule = [(start + random.uniform(0, 300 / args.speed), d) for d in range(args.devices)]
+    heapq.heapify(schedule)
+    lock = threading.Lock()
+    args.workers = min(args.workers, args.devices)
+
+    def worker():
+        while True:
+            with lock:
+                if not schedule:
+                    # more workers than devices awake right now
+                    due = None
+                else:
+                    due, device = heapq.heappop(schedule)
+            if due is None:
+                if time.monotonic() >= end:
+                    return
+                time.sleep(0.1)
+                continue
+            if due >= end:
+                return
+            time.sleep(max(due - time.monotonic(), 0))
+            stats.add('lag', time.monotonic() - due)
+            wake(device, args, link, stats, sessions)
+            interval = (240 if device in pumping else 300) / args.speed
+            with lock:
+                heapq.heappush(schedule, (due + interval, device))
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(args.workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - start
+
+    print(f'devices {args.devices} ({len(pumping)} pumping), workers {args.workers}, {elapsed:.0f} s')
+    print(f'wakes {stats.wakes}, failed {stats.failed_wakes}, {stats.bytes / max(stats.wakes, 1):.0f} bytes per wake')
+    print(f'publish throughput {stats.published / elapsed:.1f} msg/s ({stats.published} QoS1)')
+    print(f'PUBACK latency  {percentiles(stats.puback)}')
+    print(f'CONNACK latency {percentiles(stats.connect)}')
+    if args.context:
+        print(f'TLS handshake   {percentiles(stats.handshake)}, '
+              f'{sum(stats.handshake_bytes) / max(len(stats.handshake_bytes), 1):.0f} bytes, '
+              f'{stats.resumed} of {len(stats.handshake)} resumed')
+    print(f'wake lag        {percentiles(stats.lag)}  (high values mean too few workers)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate a fleet of pumps against an MQTT broker')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=0, help='1883, or 8883 with TLS')
+    parser.add_argument('--topic', default='telemetry/pump')
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=200, help='concurrent wakes')
+    parser.add_argument('--duration', type=float, default=300, help='seconds')
+    parser.add_argument('--speed', type=float, default=1, help='schedule compression factor')
+    parser.add_argument('--pumping', type=float, default=0.3, help='fraction of devices in the pump loop')
+    parser.add_argument('--latency', type=float, default=600, help='one way GPRS latency in ms')
+    parser.add_argument('--jitter', type=float, default=200, help='latency std dev in ms')
+    parser.add_argument('--loss', type=float, default=0.02, help='segment loss probability')
+    parser.add_argument('--bandwidth', type=int, default=4000, help='bytes/s per device')
+    parser.add_argument('--tls', action='store_true')
+    parser.add_argument('--cafile', help='CA for the broker certificate')
+    parser.add_argument('--tls12', action='store_true', help='cap TLS at 1.2')
+    parser.add_argument('--resume', action='store_true', help='resume TLS sessions across wakes')
+    parser.add_argument('--psk', help='IDENTITY:HEXKEY, implies --tls')
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,69 +1,111 @@
-from machine import Pin, ADC, RTC, WDT, deepsleep
+from machine import Pin, ADC, RTC, WDT, deepsleep, lightsleep
 from time import sleep, sleep_ms
-from umqtt import MQTTClient
 import gc
 import ds18x20
 import onewire
-import sim800
-import socket
-import struct
 import utime
+from scheduler import Scheduler
 
 
 '''  TODO
 remove phys leds
 '''
 
-# Modem SIM800L
-modem = sim800.Modem(modem_pwkey_pin=4,
-                     modem_rst_pin=5,
-                     modem_power_on_pin=23,
-                     modem_tx_pin=26,
-                     modem_rx_pin=27)
-gc.collect()
+# Modem SIM800L, created by init_modem() once a wake goes online
+modem = None
 
-# temp ds18b20
+# temp ds18b20, all sensors share one bus
 ds_pin = Pin(0)
 temp_sensor = ds18x20.DS18X20(onewire.OneWire(ds_pin))
 
-# cap moisture sensor + cal
-sm_air = 755
-sm_water = 324
-sm_adc = ADC(Pin(2))
-
-# rain sensor + cal
-rd_air = 1023
-rd_water = 236
-rd_adc = ADC(Pin(15))
-
 # battery
 bat_adc = ADC(Pin(12))
 bat_adc.width(ADC.WIDTH_12BIT)
 bat_adc.atten(ADC.ATTN_11DB)
 
-# relay
-relay = Pin(14, Pin.OUT)
+# zones: relay pin, ROM id of the DS18B20 in hex ('' when it is the only
+# probe on the bus), cap moisture and rain sensor as (adc pin, air, water) cal.
+# The first zone has no name and keeps the plain telemetry/pump/* topics.
+zone_config = [
+    {'name': '', 'relay': 14, 'temp': '', 'soil': (2, 755, 324), 'rain': (15, 1023, 236)},
+]
+
+
+class Zone:
+    def __init__(self, name, relay, temp=None, soil=None, rain=None):
+        self.name = name
+        self.relay = Pin(relay, Pin.OUT)  # keeps its level through light sleep
+        self.temp = temp
+        self.probes = {}
+        for kind, cal in (('soil', soil), ('rain', rain)):
+            if cal:
+                adc = ADC(Pin(cal[0]))
+                adc.atten(ADC.ATTN_11DB)
+                self.probes[kind] = (adc, cal[1], cal[2])
+
+    def key(self, kind):
+        return f'{self.name}/{kind}' if self.name else kind
+
+
+zones = [Zone(**z) for z in zone_config]
 
 # misc
+debug = False  # tty and WDT grace delays for bench work
+trace = False  # AT transcript ring buffer, saved to trace_file on failure
+trace_file = 'at_trace.bin'
 onboard_led = Pin(13, Pin.OUT)
 sensor_reads = 10
 sensor_delay_ms = 200
+capture = False  # append raw sample streams to capture_file for replay.py
+capture_reads = 40
+capture_file = 'capture.bin'
+capture_max = 512 * 1024  # bytes of flash the capture may use
 synced_time = False
+sampled = False  # set by the first sampling pass of a boot
 online = False
 ntp_delta = 3155673600
 service_retries = 5
+pump_interval_ms = 240000
+min_signal = 0.25  # CSQ 8, about -97 dBm, below this only pump wakes go online
+bulk_signal = 0.5  # CSQ 15, about -83 dBm, needed to upload deferred readings
+reg_wait_s = 30
+rssi = 0.0
+link = ''
+deferred_file = 'deferred.txt'
+deferred_max = 64 * 1024  # bytes of flash deferred readings may use
+flush_margin_ms = 60000  # network budget left when the flush of deferred.txt stops
+flushing = False
+tls = False  # MQTT over TLS, one context for the whole wake
+tls_ca = 'ca.der'
+mqtt_client = None
+mqtt_version = 4  # 5 for topic aliases and message expiry
+session_expiry_s = 86400  # MQTT 5, keep the broker session through deep sleep
+reading_expiry_s = 3600  # MQTT 5, stale readings are dropped by the broker
+net_cache_file = 'netcache.json'
+net_cache = {}
+scan_interval_s = 7 * 86400  # full AT+COPS=? scan, at most weekly
 host = "se.pool.ntp.org"
 rtc = RTC()
 gc.collect()
 
-# WDT
+# task budgets, a task past its budget sends the board to deep sleep
+sense_budget_ms = 30000
+network_budget_ms = 300000
+pump_margin_ms = 600000  # on top of the time left in the pump window
+light_sleep_ms = 10000  # idle waits this long or longer use light sleep
+
+# WDT, fed by the scheduler only
+wdt_timeout_ms = 180000  # longest single blocking step, AT+COPS=? included
 print('enabling WDT')
-sleep(5)
-wdt = WDT(timeout=900000)  # 15min WDT, feed from read_sensors()
+if debug:
+    sleep(5)
+wdt = WDT(timeout=wdt_timeout_ms)
 wdt.feed()
 
 
 def ntp_time():
+    import socket
+    import struct
     ntp_query = bytearray(48)
     ntp_query[0] = 0x1B
     msg = None
@@ -83,6 +125,7 @@ def ntp_time():
         finally:
             s.close()
         i += 1
+        yield 0
     if msg:
         val = struct.unpack("!I", msg[40:44])[0]
         tm = utime.gmtime(val - ntp_delta)
@@ -97,24 +140,7 @@ def filter_reads(data):
     return sum(lst)/len(lst)
 
 
-def temp_read():
-    raw_data = []
-    ds18b20 = temp_sensor.scan()[0]
-    for _ in range(0, sensor_reads):
-        temp_sensor.convert_temp()
-        sleep_ms(50)
-        raw_data.append(temp_sensor.read_temp(ds18b20))
-        sleep_ms(sensor_delay_ms)
-    return f'{filter_reads(raw_data):.2f}'
-
-
-def cap_read(adc, air, water):
-    raw_data = []
-    adc.width(ADC.WIDTH_10BIT)
-    adc.atten(ADC.ATTN_11DB)
-    for _ in range(0, sensor_reads):
-        raw_data.append(adc.read())
-        sleep_ms(sensor_delay_ms)
+def cap_level(raw_data, air, water):
     res = filter_reads(raw_data)
     if air < res:
         res = air
@@ -124,73 +150,325 @@ def cap_read(adc, air, water):
     return f'{return_res:.2f}'
 
 
-def read_bat():
-    raw_data = []
-    for _ in range(0, sensor_reads):
-        raw_data.append(bat_adc.read_uv()/1000000*0.975*7.665)
-        sleep_ms(sensor_delay_ms)
-    res = filter_reads(raw_data)
+def bat_level(raw_data):
+    res = filter_reads([uv/1000000*0.975*7.665 for uv in raw_data])
     if res < 2:
         res = 0
     return f'{res:.2f}'
 
 
+def sample_all(reads):
+    # One pass over every channel: a single broadcast convert_temp() per
+    # round for the whole 1-Wire bus, then every ADC and every ROM is read
+    global sampled
+    if not sampled:
+        print('first sample at {} ms'.format(utime.ticks_ms()))  # boot to first read
+        sampled = True
+    from ubinascii import hexlify
+    roms = temp_sensor.scan()
+    found = {hexlify(rom).decode(): rom for rom in roms}
+    if len(roms) == 1:
+        found[''] = roms[0]
+    temps = []
+    for z in zones:
+        if z.temp is None:
+            continue
+        if z.temp in found:
+            temps.append((z, found[z.temp]))
+        else:
+            print('no DS18B20 {!r} for zone {!r}, bus has {}'.format(z.temp, z.name, list(found)))
+    probes = [(z, kind, p[0]) for z in zones for kind, p in z.probes.items()]
+    raw = {'battery': []}
+    for z, _ in temps:
+        raw[z.key('temp')] = []
+    for z, kind, _ in probes:
+        raw[z.key(kind)] = []
+    for _ in range(0, reads):
+        temp_sensor.convert_temp()
+        # the width is per ADC block and the battery shares ADC2 with the
+        # probes on GPIO 2 and 15, so set it before each group is read
+        bat_adc.width(ADC.WIDTH_12BIT)
+        raw['battery'].append(bat_adc.read_uv())
+        for z, kind, adc in probes:
+            adc.width(ADC.WIDTH_10BIT)
+            raw[z.key(kind)].append(adc.read())
+        yield 50
+        for z, rom in temps:
+            raw[z.key('temp')].append(temp_sensor.read_temp(rom))
+        yield sensor_delay_ms
+    return raw
+
+
+def save_capture(raw):
+    # Record: b'RAW1', time, reads, delay, channel count, then per channel
+    # name, kind ('b' battery uV, 't' temp 1/16 C, 'a' ADC), air, water
+    # and the samples as int32
+    import os
+    import struct
+    from array import array
+    try:
+        if os.stat(capture_file)[6] > capture_max:
+            return
+    except OSError:
+        pass
+    channels = [('battery', b'b', 0, 0)]
+    for z in zones:
+        if z.key('temp') in raw:
+            channels.append((z.key('temp'), b't', 0, 0))
+        for kind, (_, air, water) in z.probes.items():
+            channels.append((z.key(kind), b'a', air, water))
+    with open(capture_file, 'ab') as f:
+        f.write(struct.pack('<4sIHHB', b'RAW1', utime.time(), len(raw['battery']), sensor_delay_ms, len(channels)))
+        for name, kind, air, water in channels:
+            scale = 16 if kind == b't' else 1
+            f.write(struct.pack('<B', len(name)) + name.encode() + struct.pack('<cHH', kind, air, water))
+            f.write(array('i', [int(round(v * scale)) for v in raw[name]]))
+
+
 def read_sensors():
-    wdt.feed()
     try:
-        res = {
-            'battery': read_bat(),
-            'temp': temp_read(),
-            'soil': cap_read(sm_adc, sm_air, sm_water),
-            'rain': cap_read(rd_adc, rd_air, rd_water),
-            'relay': str(relay.value())
-            }
+        raw = yield from sample_all(capture_reads if capture else sensor_reads)
+        if capture:
+            try:
+                save_capture(raw)
+            except:
+                print('capture not saved')  # e.g. flash full, the readings still count
+        res = {'battery': bat_level(raw['battery'])}
+        for z in zones:
+            if z.temp is not None:
+                temps = raw.get(z.key('temp'))
+                res[z.key('temp')] = f"{filter_reads(temps):.2f}" if temps else '0'
+            for kind, (_, air, water) in z.probes.items():
+                res[z.key(kind)] = cap_level(raw[z.key(kind)], air, water)
+            res[z.key('relay')] = str(z.relay.value())
     except:
-        res = {
-            'battery': '0',
-            'temp': '0',
-            'soil': '0',
-            'rain': '0',
-            'relay': '0',
-        }
-    wdt.feed()
+        res = {'battery': '0'}
+        for z in zones:
+            for kind in ('temp', 'soil', 'rain', 'relay'):
+                res[z.key(kind)] = '0'
     return res
 
 
-def run_pump():
-    relay.on()
-    while 17 <= rtc.datetime()[4] <= 18:
+def relays(on):
+    for z in zones:
+        z.relay.value(on)
+
+
+def pump_task():
+    relays(1)
+    while flushing:
+        yield 1000  # the flush owns the MQTT connection, the pump is already on
+    while pump_window():
         print('pump loop')
-        sensors = read_sensors()
-        mqtt_status = post_mqtt(sensors)
+        sensors = yield from read_sensors()
+        mqtt_status = yield from post_mqtt(sensors)
         if not mqtt_status:
             print('failed to post mqtt')
-            power_down()
+            break
         if float(sensors.get('battery')) < 11.7:
             print('low voltage cut-off')
             break
-        sleep(240)  # 4 min wait, 2 wdt feeds
-    relay.off()
+        yield from pump_sleep()
+    relays(0)
+    scan_maintenance()
 
 
-def connect_mqtt():
-    wdt.feed()
+def pump_budget_ms():
+    dt = rtc.datetime()
+    left_s = (18 - dt[4]) * 3600 + (59 - dt[5]) * 60 + 60 - dt[6]
+    return max(left_s, 0) * 1000 + pump_margin_ms
+
+
+def pump_sleep():
     global online
-    if not modem.ppp.isconnected() or not online:
-        online = init_modem()
-    broker = MQTTClient("", "", user="", password="", port=)
+    try:
+        modem.sleep()
+    except:
+        pass
+    online = False
+    yield pump_interval_ms  # light sleep in the scheduler, woken by the RTC timer
+    try:
+        modem.wake()
+    except:
+        yield from reset_modem(modem)
+
+
+def pump_window():
+    return 17 <= rtc.datetime()[4] <= 18
+
+
+def load_net_cache():
+    import json
+    try:
+        with open(net_cache_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_net_cache():
+    import json
+    with open(net_cache_file, 'w') as f:
+        json.dump(net_cache, f)
+
+
+def select_network():
+    global net_cache
+    net_cache = load_net_cache()
+    if modem.is_registered():
+        return  # pump loop re-attach, keep the current registration
+    if net_cache.get('band'):
+        try:
+            modem.set_band(net_cache['band'])
+        except:
+            net_cache['band'] = None
+    if net_cache.get('operator'):
+        try:
+            modem.select_operator(net_cache['operator'])
+        except:
+            net_cache['operator'] = None
+
+
+def remember_network():
+    operator = modem.get_operator()
+    band = modem.get_band()
+    if operator != net_cache.get('operator') or band != net_cache.get('band'):
+        net_cache['operator'] = operator
+        net_cache['band'] = band
+        save_net_cache()
+
+
+def scan_maintenance():
+    if not synced_time:
+        return  # the interval means nothing without NTP time
+    now = utime.time()
+    if now - net_cache.get('scanned', 0) < scan_interval_s:
+        return
+    # a failed or timed out scan also waits for the next interval
+    net_cache['scanned'] = now
+    save_net_cache()
+    try:
+        modem.hangup()
+        networks = modem.scan_networks()
+    except:
+        return
+    net_cache['networks'] = networks
+    if net_cache.get('operator') not in [n['id'] for n in networks]:
+        net_cache['operator'] = None
+    save_net_cache()
+
+
+def preflight(high_priority):
+    global rssi, link
+    rssi = 0.0
+    i = 0
+    while not modem.is_registered():
+        yield 1000
+        i += 1
+        if i > reg_wait_s:
+            link = 'noreg'
+            return False
+    try:
+        remember_network()
+    except:
+        pass  # the cache is best effort, the modem is registered
+    rssi = modem.get_signal_strength()
+    if rssi < min_signal and not high_priority:
+        link = 'weak'
+        return False
+    link = 'online'
+    return True
+
+
+def tag_link(data):
+    data['rssi'] = f'{rssi:.2f}'
+    data['link'] = link
+
+
+def defer(data):
+    import json
+    import os
+    try:
+        if os.stat(deferred_file)[6] > deferred_max:
+            return
+    except OSError:
+        pass
+    data['ts'] = str(utime.time())
+    with open(deferred_file, 'a') as f:
+        f.write(json.dumps(data) + '\n')
+
+
+def flush_deferred(broker, deadline):
+    # Line by line until the deadline (ticks_ms), whatever was not published
+    # is written back for the next flush
+    import os
+    from umqtt import MQTTException
+    global flushing
+    try:
+        os.stat(deferred_file)
+    except OSError:
+        return
+    flushing = True
+    keep_file = deferred_file + '.tmp'
+    kept = 0
+    with open(deferred_file) as f:
+        with open(keep_file, 'w') as keep:
+            for line in f:
+                if broker and utime.ticks_diff(deadline, utime.ticks_ms()) > 0:
+                    try:
+                        broker.publish('telemetry/pump/deferred', line.rstrip('\n'), qos=1)
+                    except MQTTException:
+                        pass  # rejected by the broker, try again next flush
+                    except OSError:
+                        broker = yield from connect_mqtt()  # the line is kept
+                    else:
+                        yield 0
+                        continue
+                keep.write(line)
+                kept += 1
+    os.remove(deferred_file)
+    if kept:
+        os.rename(keep_file, deferred_file)
+    else:
+        os.remove(keep_file)
+    flushing = False
+
+
+def tls_context():
+    import ssl
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.load_verify_locations(cafile=tls_ca)
+    return context
+
+
+def connect_mqtt():
+    from umqtt import MQTTClient
+    global online, mqtt_client
+    if not online or not modem.ppp.isconnected():
+        online = yield from init_modem()
+    # kept across reconnects so TLS reuses its context, MicroPython's ssl
+    # cannot resume sessions so every connect is a full handshake
+    if mqtt_client is None:
+        mqtt_client = MQTTClient("", "", user="", password="", port=,
+                                 ssl=tls_context() if tls else False,
+                                 version=mqtt_version, session_expiry=session_expiry_s)
+        # SNI and the hostname check, else any certificate from tls_ca passes
+        mqtt_client.ssl_params = {'server_hostname': mqtt_client.server}
+    broker = mqtt_client
     i = 0
 
     if online:
+        if broker.sock:
+            broker.sock.close()  # a reconnect replaces the previous socket
         while i < service_retries:
             try:
                 status = broker.connect(clean_session=False)
                 if status == 1:
                     return broker
             except:
-                broker = MQTTClient("", "", user="", password="", port=)
                 pass
-            sleep_ms(250)
+            yield 250
             i += 1
         else:
             return False
@@ -198,70 +476,148 @@ def connect_mqtt():
 
 
 def post_mqtt(data):
+    from umqtt import MQTTException
     success = False
-    broker = connect_mqtt()
+    broker = yield from connect_mqtt()
+    tag_link(data)
     for k, v in data.items():
         i = 0
         if broker:
             while i < service_retries:
                 try:
-                    broker.publish(f'telemetry/pump/{k}', v, qos=1)
+                    broker.publish(f'telemetry/pump/{k}', v, qos=1, expiry=reading_expiry_s)
                     success = True
                     break
+                except MQTTException:
+                    break  # rejected by the broker, a reconnect won't change that
                 except OSError:
-                    broker = connect_mqtt()
-                sleep_ms(250)
+                    broker = yield from connect_mqtt()
+                yield 250
                 i += 1
-    return success
+        yield 0
+    return success and broker  # still connected, reused by flush_deferred()
 
 
 def reset_modem(modem):
     print('modem power reset')
     modem.modem_power_on_pin_obj.off()
-    sleep(2)
+    yield 2000
     modem.modem_power_on_pin_obj.on()
-    sleep(5)
-
-
-def init_modem():
+    yield 5000
+
+
+def init_modem(high_priority=True):
+    global modem, link
+    if modem is None:
+        import sim800
+        modem = sim800.Modem(modem_pwkey_pin=4,
+                             modem_rst_pin=5,
+                             modem_power_on_pin=23,
+                             modem_tx_pin=26,
+                             modem_rx_pin=27,
+                             trace=sim800.TraceBuffer() if trace else None)
+        gc.collect()
     try:
         modem.initialize()
-        # TODO: save RSSI before PPPoS setup?
+        select_network()
+        if not (yield from preflight(high_priority)):
+            return False
         modem.ppp_connect()
         i = 0
         while not modem.ppp.isconnected():
-            sleep(1)
+            yield 1000
             i += 1
             if i > 25:
-                reset_modem(modem)
+                link = 'failed'
+                save_trace()
+                yield from reset_modem(modem)
                 return False
     except:
-        reset_modem(modem)
+        link = 'failed'
+        save_trace()
+        yield from reset_modem(modem)
         return False
     return True
 
 
+def save_trace():
+    if modem and modem.trace:
+        modem.trace.save(trace_file)
+
+
 def power_down():
-    relay.off()
+    relays(0)
     print('going to sleep')
-    sleep(3)
+    if debug:
+        sleep(3)
     deepsleep(300000)  # 5 min deep sleep
 
 
-if __name__ == "__main__":
-    print('wait for tty')
-    sleep(3)
-    online = init_modem()
-    wdt.feed()
+def sense_task():
+    sensors = yield from read_sensors()
+    return sensors
+
+
+def network_task(sched, sense):
+    # waits for sense_task, the first modem step blocks for up to a minute
+    # (AT+COPS=4) and would hold sampling past its budget
+    global online, synced_time
+    flush_deadline = utime.ticks_add(utime.ticks_ms(), network_budget_ms - flush_margin_ms)
+    while not sense.done:
+        yield 100
+    sensors = sense.result
+    online = yield from init_modem(high_priority=pump_window())
 
     if online:
-        synced_time = ntp_time()
+        synced_time = yield from ntp_time()
         print(rtc.datetime())
-        sensors = read_sensors()
-        mqtt_status = post_mqtt(sensors)
+        broker = yield from post_mqtt(sensors)
+
+        pumping = synced_time and float(sensors.get('battery')) > 11.9 and pump_window()
+        if pumping:
+            sched.add('pump', pump_task(), pump_budget_ms())
+        if broker and rssi >= bulk_signal:
+            yield from flush_deferred(broker, flush_deadline)
+        if not pumping:
+            scan_maintenance()  # the pump task scans when it ends
+    else:
+        tag_link(sensors)
+        defer(sensors)
+
+
+def idle(ms):
+    if ms >= light_sleep_ms:
+        lightsleep(ms)
+    else:
+        sleep_ms(ms)
+
+
+def fail(task):
+    import sys
+    relays(0)
+    if task.error is None:
+        print('task {} over budget'.format(task.name))
+    else:
+        print('task {} failed'.format(task.name))
+        sys.print_exception(task.error)
+    try:
+        save_trace()
+    except OSError:
+        pass
+    power_down()
 
-        if synced_time and float(sensors.get('battery')) > 11.9:
-            if 17 <= rtc.datetime()[4] <= 18:
-                run_pump()
+
+def main():
+    if debug:
+        print('wait for tty')
+        sleep(3)
+    sched = Scheduler(wdt, fail, idle=idle, feed_ms=wdt_timeout_ms // 2)
+    sense = sched.add('sense', sense_task(), sense_budget_ms)
+    sched.add('network', network_task(sched, sense), network_budget_ms)
+    sched.run()
     power_down()
 
+
+if __name__ == "__main__":
+    main()
+
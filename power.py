@@ -0,0 +1,44 @@
+'''Rough energy budget for one pumping hour, runs on the board or CPython.
+
+Currents in mA (ESP32 / SIM800L datasheets and bench readings), times in s.
+'''
+
+# ESP32
+cpu_active = 45
+cpu_light_sleep = 0.8
+
+# SIM800L
+modem_report = 120  # average while attaching PPP and posting
+modem_ppp_idle = 22  # registered, PPP up, no traffic
+modem_sleep = 1.2  # AT+CSCLK=2, still registered
+
+# relay coil, the same for every loop
+relay_coil = 70
+
+# pump loop
+interval_s = 240
+report_s = 10  # read_sensors() + post_mqtt() with PPP already up
+ppp_attach_s = 12  # extra time to wake the modem and bring PPP back up
+
+
+def pump_hour_mah(report, idle_cpu, idle_modem):
+    reports = 3600 / interval_s
+    idle = max(interval_s - report, 0)
+    per_report = report * (cpu_active + modem_report) + idle * (idle_cpu + idle_modem)
+    return reports * per_report / 3600 + relay_coil
+
+
+def awake_loop():
+    return pump_hour_mah(report_s, cpu_active, modem_ppp_idle)
+
+
+def light_sleep_loop():
+    return pump_hour_mah(report_s + ppp_attach_s, cpu_light_sleep, modem_sleep)
+
+
+if __name__ == "__main__":
+    awake = awake_loop()
+    light = light_sleep_loop()
+    print(f'awake loop:       {awake:.1f} mAh per pumping hour')
+    print(f'light sleep loop: {light:.1f} mAh per pumping hour')
+    print(f'saving:           {awake - light:.1f} mAh ({(awake - light) * 100 / awake:.0f}%)')
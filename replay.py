@@ -0,0 +1,120 @@
+'''Replay raw sample captures through the sensor filters, CPython + NumPy.
+
+    python replay.py capture.bin [--tol-adc 1.0] [--tol-temp 0.1] [--tol-bat 0.05]
+
+capture.bin is written by main.py with capture = True. For every channel
+and every sample count n up to half a capture, each wake is cut into
+disjoint windows of n consecutive samples. Every window is run through
+vectorised copies of filter_reads(), cap_level() and bat_level() and
+compared with the reading from the rest of that wake, which shares no
+samples with it. The smallest n that keeps the p95 error within tolerance
+is the cheapest sensor_reads setting that still gives stable readings.
+'''
+import argparse
+import struct
+import sys
+
+import numpy as np
+
+TRIM = 2  # samples dropped at each end by filter_reads()
+ROUND_MS = 50  # conversion wait in sample_all(), added to sensor_delay_ms
+UNITS = {b'a': '%', b't': 'C', b'b': 'V'}
+
+
+def load(path):
+    records = []
+    with open(path, 'rb') as f:
+        data = f.read()
+    pos = 0
+    while pos < len(data):
+        magic, ts, reads, delay_ms, count = struct.unpack_from('<4sIHHB', data, pos)
+        if magic != b'RAW1':
+            sys.exit(f'{path}: bad record at byte {pos}')
+        pos += struct.calcsize('<4sIHHB')
+        channels = {}
+        for _ in range(count):
+            n = data[pos]
+            name = data[pos + 1:pos + 1 + n].decode()
+            pos += 1 + n
+            kind, air, water = struct.unpack_from('<cHH', data, pos)
+            pos += struct.calcsize('<cHH')
+            samples = np.frombuffer(data, '<i4', reads, pos).astype(float)
+            pos += 4 * reads
+            channels[name] = (kind, air, water, samples)
+        records.append({'time': ts, 'reads': reads, 'delay_ms': delay_ms, 'channels': channels})
+    return records
+
+
+def filter_reads(x):
+    return np.sort(x, axis=-1)[..., TRIM:-TRIM].mean(axis=-1)
+
+
+def cap_level(x, air, water):
+    res = np.clip(filter_reads(x), water, air)
+    return (air - res) * 100 / (air - water)
+
+
+def bat_level(x):
+    res = filter_reads(x / 1000000 * 0.975 * 7.665)
+    return np.where(res < 2, 0, res)
+
+
+def level(kind, air, water, x):
+    if kind == b'a':
+        return cap_level(x, air, water)
+    if kind == b't':
+        return filter_reads(x / 16)
+    return bat_level(x)
+
+
+def window_errors(kind, air, water, samples, n):
+    # Disjoint windows of n samples, each against the rest of the capture
+    count = len(samples) // n
+    windows = samples[:count * n].reshape(count, n)
+    errors = np.empty(count)
+    for i in range(count):
+        rest = np.delete(samples, np.s_[i * n:(i + 1) * n])
+        errors[i] = abs(level(kind, air, water, windows[i]) - level(kind, air, water, rest))
+    return errors
+
+
+def analyse(records, tolerance):
+    channels = {}
+    for rec in records:
+        for name, (kind, air, water, samples) in rec['channels'].items():
+            channels.setdefault(name, []).append((kind, air, water, samples, rec['delay_ms']))
+    for name, runs in sorted(channels.items()):
+        kind = runs[0][0]
+        reads = min(len(r[3]) for r in runs)
+        delay_ms = runs[0][4]
+        print(f'\n{name} ({len(runs)} wakes, {reads} samples each, tolerance {tolerance[kind]} {UNITS[kind]})')
+        print(f'{"n":>4} {"time ms":>8} {"mean err":>9} {"p95 err":>9} {"max err":>9}')
+        best = None
+        # the rest of the capture needs as many samples as the window
+        for n in range(2 * TRIM + 1, reads // 2 + 1):
+            errors = np.concatenate([window_errors(kind, air, water, samples[:reads], n)
+                                     for _, air, water, samples, _ in runs])
+            p95 = np.percentile(errors, 95)
+            if best is None and p95 <= tolerance[kind]:
+                best = n
+            print(f'{n:>4} {n * (ROUND_MS + delay_ms):>8} {errors.mean():>9.3f} {p95:>9.3f} {errors.max():>9.3f}')
+        if best:
+            print(f'-> {best} samples ({best * (ROUND_MS + delay_ms)} ms) within tolerance')
+        else:
+            print('-> no sample count within tolerance, capture more samples')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay raw sensor captures through the filters')
+    parser.add_argument('capture')
+    parser.add_argument('--tol-adc', type=float, default=1.0, help='soil and rain, in %%')
+    parser.add_argument('--tol-temp', type=float, default=0.1, help='in C')
+    parser.add_argument('--tol-bat', type=float, default=0.05, help='in V')
+    args = parser.parse_args()
+    records = load(args.capture)
+    print(f'{len(records)} wakes in {args.capture}')
+    analyse(records, {b'a': args.tol_adc, b't': args.tol_temp, b'b': args.tol_bat})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+'''Deadline based cooperative scheduler that owns the watchdog.
+
+Tasks are generators. Every yield is a progress point and may give the ms
+to wait before the task runs again. The watchdog is only fed here: after
+a step returned within its task's budget, or while every task is waiting.
+A step that hangs is caught by the watchdog. A task that runs past its
+budget or raises is dropped and on_fail(task) is called, task.error holds
+the exception or None for an overrun.
+'''
+from time import ticks_ms, ticks_add, ticks_diff, sleep_ms
+
+
+class Task:
+    def __init__(self, name, gen, budget_ms):
+        self.name = name
+        self.gen = gen
+        self.due = ticks_ms()
+        self.deadline = ticks_add(self.due, budget_ms)
+        self.done = False
+        self.result = None
+        self.error = None
+
+
+class Scheduler:
+    def __init__(self, wdt, on_fail, idle=sleep_ms, feed_ms=60000):
+        self.wdt = wdt
+        self.on_fail = on_fail
+        self.idle = idle
+        self.feed_ms = feed_ms  # longest idle between feeds, below the WDT timeout
+        self.tasks = []
+
+    def add(self, name, gen, budget_ms):
+        task = Task(name, gen, budget_ms)
+        self.tasks.append(task)
+        return task
+
+    def run(self):
+        while self.tasks:
+            now = ticks_ms()
+            for task in self.tasks:
+                if ticks_diff(now, task.deadline) > 0:
+                    self.tasks.remove(task)
+                    self.on_fail(task)
+                    return
+            task = min(self.tasks, key=lambda t: ticks_diff(t.due, now))
+            wait = ticks_diff(task.due, now)
+            if wait > 0:
+                deadline = min(ticks_diff(t.deadline, now) for t in self.tasks)
+                self.idle(min(wait, deadline + 1, self.feed_ms))
+                self.wdt.feed()
+                continue
+            try:
+                delay = next(task.gen)
+            except StopIteration as e:
+                task.done = True
+                task.result = e.args[0] if e.args else None
+                self.tasks.remove(task)
+            except Exception as e:
+                task.error = e
+                self.tasks.remove(task)
+                self.on_fail(task)
+                return
+            else:
+                task.due = ticks_add(ticks_ms(), delay or 0)
+            if ticks_diff(ticks_ms(), task.deadline) <= 0:
+                self.wdt.feed()
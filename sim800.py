@@ -1,5 +1,6 @@
 import time
 import json
+import struct
 
 try:
     import logging
@@ -34,6 +35,58 @@ class ModemTimeout(Exception):
     pass
 
 
+class TraceBuffer(object):
+    # Fixed size slots: ticks_ms (4), kind (1), length (1), line (26)
+    SLOT = 32
+    TX = 0x3e  # '>'
+    RX = 0x3c  # '<'
+    TIMEOUT = 0x21  # '!'
+
+    def __init__(self, slots=64):
+        self.buf = bytearray(slots * self.SLOT)
+        self.slots = slots
+        self.pos = 0
+        self.count = 0
+
+    def record(self, kind, data):
+        off = self.pos * self.SLOT
+        n = min(len(data), self.SLOT - 6)
+        struct.pack_into('<IBB', self.buf, off, time.ticks_ms(), kind, n)
+        self.buf[off + 6:off + 6 + n] = data[:n]
+        self.pos = (self.pos + 1) % self.slots
+        if self.count < self.slots:
+            self.count += 1
+
+    def entries(self):
+        first = (self.pos - self.count) % self.slots
+        for i in range(self.count):
+            off = ((first + i) % self.slots) * self.SLOT
+            ticks, kind, n = struct.unpack_from('<IBB', self.buf, off)
+            yield ticks, kind, bytes(self.buf[off + 6:off + 6 + n])
+
+    def dump(self):
+        prev = None
+        for ticks, kind, data in self.entries():
+            delta = 0 if prev is None else (ticks - prev) & 0x3fffffff
+            prev = ticks
+            print('{:>10} +{:>6} {} {}'.format(ticks, delta, chr(kind), data))
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(struct.pack('<HHH', self.slots, self.pos, self.count))
+            f.write(self.buf)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            slots, pos, count = struct.unpack('<HHH', f.read(6))
+            trace = cls(slots)
+            trace.buf[:] = f.read(slots * cls.SLOT)
+        trace.pos = pos
+        trace.count = count
+        return trace
+
+
 class Response(object):
     def __init__(self, status_code, content):
         self.status_code = int(status_code)
@@ -47,7 +100,8 @@ class Modem(object):
                  modem_rst_pin=None, 
                  modem_power_on_pin=None, 
                  modem_tx_pin=None, 
-                 modem_rx_pin=None):
+                 modem_rx_pin=None,
+                 trace=None):
         
         self.modem_pwkey_pin = modem_pwkey_pin
         self.modem_rst_pin = modem_rst_pin
@@ -55,6 +109,7 @@ class Modem(object):
         self.modem_tx_pin = modem_tx_pin
         self.modem_rx_pin = modem_rx_pin
         self.uart = uart
+        self.trace = trace
         self.ppp = None
         self.initialized = False
         self.modem_info = None
@@ -111,6 +166,10 @@ class Modem(object):
                     'battery':     {'string': 'AT+CBC', 'timeout': 3, 'end': 'OK'},
                     'scan':        {'string': 'AT+COPS=?', 'timeout': 60, 'end': 'OK'},
                     'network':     {'string': 'AT+COPS?', 'timeout': 3, 'end': 'OK'},
+                    'opformat':    {'string': 'AT+COPS=3,2', 'timeout': 3, 'end': 'OK'},
+                    'setop':       {'string': 'AT+COPS=4,2,"{}"'.format(data), 'timeout': 60, 'end': 'OK'},
+                    'getband':     {'string': 'AT+CBAND?', 'timeout': 3, 'end': 'OK'},
+                    'setband':     {'string': 'AT+CBAND="{}"'.format(data), 'timeout': 3, 'end': 'OK'},
                     'signal':      {'string': 'AT+CSQ', 'timeout': 3, 'end': 'OK'},
                     'checkreg':    {'string': 'AT+CREG?', 'timeout': 3, 'end': 'OK'},
                     'setapn':      {'string': 'AT+SAPBR=3,1,"APN","{}"'.format(data), 'timeout': 3, 'end': 'OK'},
@@ -144,6 +203,8 @@ class Modem(object):
                     'rfoff':       {'string': 'AT+CFUN=4', 'timeout': 3, 'end': 'OK'},
                     'echoon':      {'string': 'ATE1', 'timeout': 3, 'end': 'OK'},
                     'echooff':     {'string': 'ATE0', 'timeout': 3, 'end': 'OK'},
+                    'sleepon':     {'string': 'AT+CSCLK=2', 'timeout': 3, 'end': 'OK'},
+                    'sleepoff':    {'string': 'AT+CSCLK=0', 'timeout': 3, 'end': 'OK'},
         }
 
         # Sanity checks
@@ -158,12 +219,15 @@ class Modem(object):
             timeout = commands[command].get('timeout', 3)
         processed_lines = 0
 
-        # Execute the AT command
+        # Execute the AT command, tracing is compiled out with mpy-cross -O1
         command_string_for_at = "{}\r\n".format(command_string)
-        logger.debug('Writing AT command "{}"'.format(command_string_for_at.encode('utf-8')))
+        if __debug__:
+            if self.trace:
+                self.trace.record(TraceBuffer.TX, command_string.encode())
         self.uart.write(command_string_for_at)
 
         # Support vars
+        end_line = excpected_end + '\r\n'
         pre_end = True
         output = ''
         empty_reads = 0
@@ -174,9 +238,14 @@ class Modem(object):
                 time.sleep(1)
                 empty_reads += 1
                 if empty_reads > timeout:
+                    if __debug__:
+                        if self.trace:
+                            self.trace.record(TraceBuffer.TIMEOUT, command_string.encode())
                     raise Exception('Timeout for command "{}" (timeout={})'.format(command, timeout))
             else:
-                logger.debug('Read "{}"'.format(line))
+                if __debug__:
+                    if self.trace:
+                        self.trace.record(TraceBuffer.RX, line)
 
                 # Convert line to string
                 line_str = line.decode('utf-8')
@@ -186,18 +255,15 @@ class Modem(object):
                     raise GenericATError('Got generic AT error')
 
                 # If we had a pre-end, do we have the expected end?
-                if line_str == '{}\r\n'.format(excpected_end):
-                    logger.debug('Detected exact end')
+                if line_str == end_line:
                     break
-                if pre_end and line_str.startswith('{}'.format(excpected_end)):
-                    logger.debug('Detected startwith end (and adding this line to the output too)')
+                if pre_end and line_str.startswith(excpected_end):
                     output += line_str
                     break
 
                 # Do we have a pre-end?
                 if line_str == '\r\n':
                     pre_end = True
-                    logger.debug('Detected pre-end')
                 else:
                     pre_end = False
 
@@ -226,7 +292,6 @@ class Modem(object):
             if output.endswith('\n'):
                 output = output[:-1]
 
-        logger.debug('Returning "{}"'.format(output.encode('utf8')))
         return output
 
     def get_info(self):
@@ -263,13 +328,39 @@ class Modem(object):
             return None
         return network
 
+    def get_operator(self):
+        # Numeric MCC+MNC of the current operator, e.g. "24007"
+        self.execute_at_command('opformat')
+        return self.get_current_network()
+
+    def select_operator(self, operator):
+        # Manual selection, the modem falls back to automatic if it fails
+        self.execute_at_command('setop', operator)
+
+    def get_band(self):
+        output = self.execute_at_command('getband')
+        return output.split(':')[1].split(',')[0].strip().strip('"')
+
+    def set_band(self, band):
+        self.execute_at_command('setband', band)
+
     def get_signal_strength(self):
         # See more at https://m2msupport.net/m2msupport/atcsq-signal-quality/
         output = self.execute_at_command('signal')
         signal = int(output.split(':')[1].split(',')[0])
+        if signal == 99:  # not known or not detectable
+            return 0.0
         signal_ratio = float(signal)/float(30)  # 30 is the maximum value (2 is the minimum)
         return signal_ratio
 
+    def get_registration(self):
+        # +CREG: <n>,<stat>, stat 1 is registered home and 5 is roaming
+        output = self.execute_at_command('checkreg')
+        return int(output.split(',')[-1])
+
+    def is_registered(self):
+        return self.get_registration() in (1, 5)
+
     def get_ip_addr(self):
         output = self.execute_at_command('getbear')
         output = output.split('+')[-1]  # Remove potential leftovers in the buffer before the "+SAPBR:" response
@@ -436,3 +527,23 @@ class Modem(object):
         self.execute_at_command('disconnect')
         self.execute_at_command('rfoff')
         self.execute_at_command('echoon')
+
+    def hangup(self):
+        # Drop the data call but stay registered
+        if self.ppp:
+            self.ppp.active(False)
+        self.execute_at_command('syncbaud')
+        self.execute_at_command('disconnect')
+
+    def sleep(self):
+        # The modem enters sleep mode 2 once the UART has been idle for a while
+        self.hangup()
+        self.execute_at_command('sleepon')
+
+    def wake(self):
+        # In sleep mode 2 the first characters only wake the modem up
+        self.uart.write('AT\r\n')
+        time.sleep(0.1)
+        self.uart.read()
+        self.execute_at_command('syncbaud')
+        self.execute_at_command('sleepoff')
@@ -7,6 +7,93 @@ class MQTTException(Exception):
     pass
 
 
+# MQTT 5 property ids by value type
+_PROP_BYTE = (0x01, 0x17, 0x19, 0x24, 0x25, 0x28, 0x29, 0x2A)
+_PROP_SHORT = (0x13, 0x21, 0x22, 0x23)
+_PROP_INT = (0x02, 0x11, 0x18, 0x27)
+_PROP_VARINT = (0x0B,)
+_PROP_USER = 0x26
+
+
+def _varint(n):
+    res = bytearray()
+    while n > 0x7F:
+        res.append((n & 0x7F) | 0x80)
+        n >>= 7
+    res.append(n)
+    return res
+
+
+def _read_varint(buf, pos):
+    n = 0
+    sh = 0
+    while 1:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7F) << sh
+        if not b & 0x80:
+            return n, pos
+        sh += 7
+
+
+def _str(s):
+    if isinstance(s, str):
+        s = s.encode()
+    return struct.pack("!H", len(s)) + s
+
+
+def _props(props):
+    # (id, value) pairs, user properties as (0x26, (key, value))
+    buf = bytearray()
+    for pid, v in props:
+        buf.append(pid)
+        if pid in _PROP_BYTE:
+            buf.append(v)
+        elif pid in _PROP_SHORT:
+            buf += struct.pack("!H", v)
+        elif pid in _PROP_INT:
+            buf += struct.pack("!I", v)
+        elif pid in _PROP_VARINT:
+            buf += _varint(v)
+        elif pid == _PROP_USER:
+            buf += _str(v[0]) + _str(v[1])
+        else:
+            buf += _str(v)
+    return _varint(len(buf)) + buf
+
+
+def _parse_props(buf, pos):
+    # Returns {id: value}, user properties are collected as a list of pairs
+    sz, pos = _read_varint(buf, pos)
+    end = pos + sz
+    props = {}
+    while pos < end:
+        pid = buf[pos]
+        pos += 1
+        if pid in _PROP_BYTE:
+            v = buf[pos]
+            pos += 1
+        elif pid in _PROP_SHORT:
+            v = buf[pos] << 8 | buf[pos + 1]
+            pos += 2
+        elif pid in _PROP_INT:
+            v = struct.unpack_from("!I", buf, pos)[0]
+            pos += 4
+        elif pid in _PROP_VARINT:
+            v, pos = _read_varint(buf, pos)
+        else:
+            ln = buf[pos] << 8 | buf[pos + 1]
+            v = bytes(buf[pos + 2 : pos + 2 + ln])
+            pos += 2 + ln
+            if pid == _PROP_USER:
+                ln = buf[pos] << 8 | buf[pos + 1]
+                props.setdefault(pid, []).append((v, bytes(buf[pos + 2 : pos + 2 + ln])))
+                pos += 2 + ln
+                continue
+        props[pid] = v
+    return props
+
+
 class MQTTClient:
     def __init__(
         self,
@@ -18,6 +105,9 @@ class MQTTClient:
         keepalive=0,
         ssl=False,
         ssl_params={},
+        version=4,
+        session_expiry=0,
+        user_props=(),
     ):
         if port == 0:
             port = 8883 if ssl else 1883
@@ -27,6 +117,7 @@ class MQTTClient:
         self.port = port
         self.ssl = ssl
         self.ssl_params = ssl_params
+        self.ssl_session = None
         self.pid = 0
         self.cb = None
         self.user = user
@@ -36,6 +127,13 @@ class MQTTClient:
         self.lw_msg = None
         self.lw_qos = 0
         self.lw_retain = False
+        # MQTT 5: protocol level 5, session kept for session_expiry seconds
+        # after the link drops, user_props sent once with the CONNECT
+        self.mqtt5 = version == 5
+        self.session_expiry = session_expiry
+        self.user_props = user_props
+        self.alias_max = 0
+        self.aliases = {}
 
     def _send_str(self, s):
         self.sock.write(struct.pack("!H", len(s)))
@@ -67,14 +165,27 @@ class MQTTClient:
         self.sock.settimeout(25)
         addr = socket.getaddrinfo(self.server, self.port)[0][-1]
         self.sock.connect(addr)
-        if self.ssl:
+        if self.ssl is True:
             import ussl
 
             self.sock = ussl.wrap_socket(self.sock, **self.ssl_params)
+        elif self.ssl:
+            # ssl is an SSLContext kept across connects. The last session is
+            # resumed where the context supports it (CPython), MicroPython's
+            # ssl has no sessions and only saves building the context
+            params = self.ssl_params
+            if self.ssl_session is not None:
+                params = dict(params, session=self.ssl_session)
+            self.sock = self.ssl.wrap_socket(self.sock, **params)
         premsg = bytearray(b"\x10\0\0\0\0\0")
         msg = bytearray(b"\x04MQTT\x04\x02\0\0")
+        props = b""
+        if self.mqtt5:
+            msg[5] = 5
+            props = [(0x11, self.session_expiry)] if self.session_expiry else []
+            props = _props(props + [(_PROP_USER, p) for p in self.user_props])
 
-        sz = 10 + 2 + len(self.client_id)
+        sz = 10 + len(props) + 2 + len(self.client_id)
         msg[6] = clean_session << 1
         if self.user is not None:
             sz += 2 + len(self.user) + 2 + len(self.pswd)
@@ -84,7 +195,7 @@ class MQTTClient:
             msg[7] |= self.keepalive >> 8
             msg[8] |= self.keepalive & 0x00FF
         if self.lw_topic:
-            sz += 2 + len(self.lw_topic) + 2 + len(self.lw_msg)
+            sz += 2 + len(self.lw_topic) + 2 + len(self.lw_msg) + self.mqtt5
             msg[6] |= 0x4 | (self.lw_qos & 0x1) << 3 | (self.lw_qos & 0x2) << 3
             msg[6] |= self.lw_retain << 5
 
@@ -97,20 +208,46 @@ class MQTTClient:
 
         self.sock.write(premsg, i + 2)
         self.sock.write(msg)
+        if self.mqtt5:
+            self.sock.write(props)
         # print(hex(len(msg)), hexlify(msg, ":"))
         self._send_str(self.client_id)
         if self.lw_topic:
+            if self.mqtt5:
+                self.sock.write(b"\0")  # no will properties
             self._send_str(self.lw_topic)
             self._send_str(self.lw_msg)
         if self.user is not None:
             self._send_str(self.user)
             self._send_str(self.pswd)
+        if self.mqtt5:
+            return self._connack5()
         resp = self.sock.read(4)
         assert resp[0] == 0x20 and resp[1] == 0x02
         if resp[3] != 0:
             raise MQTTException(resp[3])
+        self._keep_session()
         return resp[2] & 1
 
+    def _keep_session(self):
+        # Read once the broker has replied, TLS 1.3 tickets arrive after
+        # the handshake
+        if self.ssl and self.ssl is not True:
+            self.ssl_session = getattr(self.sock, "session", None)
+
+    def _connack5(self):
+        resp = self.sock.read(1)
+        assert resp[0] == 0x20
+        resp = self.sock.read(self._recv_len())
+        if resp[1] >= 0x80:
+            raise MQTTException(resp[1])
+        props = _parse_props(resp, 2)
+        # topic aliases only live as long as the network connection
+        self.alias_max = props.get(0x22, 0)
+        self.aliases = {}
+        self._keep_session()
+        return resp[0] & 1
+
     def disconnect(self):
         self.sock.write(b"\xe0\0")
         self.sock.close()
@@ -118,10 +255,24 @@ class MQTTClient:
     def ping(self):
         self.sock.write(b"\xc0\0")
 
-    def publish(self, topic, msg, retain=False, qos=0):
+    # MQTT 5 only: expiry drops the message at the broker after that many
+    # seconds, user_props are (key, value) pairs. Repeated topics are sent
+    # as a two byte alias once the broker allows them.
+    def publish(self, topic, msg, retain=False, qos=0, expiry=0, user_props=()):
         pkt = bytearray(b"\x30\0\0\0")
         pkt[0] |= qos << 1 | retain
-        sz = 2 + len(topic) + len(msg)
+        props = b""
+        if self.mqtt5:
+            props = [(0x02, expiry)] if expiry else []
+            alias = self.aliases.get(topic)
+            if alias:
+                topic = ""
+            elif len(self.aliases) < self.alias_max:
+                alias = self.aliases[topic] = len(self.aliases) + 1
+            if alias:
+                props.append((0x23, alias))
+            props = _props(props + [(_PROP_USER, p) for p in user_props])
+        sz = 2 + len(topic) + len(props) + len(msg)
         if qos > 0:
             sz += 2
         assert sz < 2097152
@@ -139,17 +290,23 @@ class MQTTClient:
             pid = self.pid
             struct.pack_into("!H", pkt, 0, pid)
             self.sock.write(pkt, 2)
+        if self.mqtt5:
+            self.sock.write(props)
         self.sock.write(msg)
         if qos == 1:
             while 1:
                 op = self.wait_msg()
                 if op == 0x40:
-                    sz = self.sock.read(1)
-                    assert sz == b"\x02"
-                    rcv_pid = self.sock.read(2)
-                    rcv_pid = rcv_pid[0] << 8 | rcv_pid[1]
+                    sz = self._recv_len()
+                    assert sz == 2 or self.mqtt5
+                    resp = self.sock.read(sz)
+                    rcv_pid = resp[0] << 8 | resp[1]
+                    # MQTT 5 omits the reason code on success
+                    reason = resp[2] if sz > 2 else 0
                     if pid == rcv_pid:
-                        return
+                        if reason >= 0x80:
+                            raise MQTTException(reason)
+                        return reason
         elif qos == 2:
             assert 0
 
@@ -157,19 +314,21 @@ class MQTTClient:
         assert self.cb is not None, "Subscribe callback is not set"
         pkt = bytearray(b"\x82\0\0\0")
         self.pid += 1
-        struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1, self.pid)
+        struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1 + self.mqtt5, self.pid)
         # print(hex(len(pkt)), hexlify(pkt, ":"))
         self.sock.write(pkt)
+        if self.mqtt5:
+            self.sock.write(b"\0")  # no properties
         self._send_str(topic)
         self.sock.write(qos.to_bytes(1, "little"))
         while 1:
             op = self.wait_msg()
             if op == 0x90:
-                resp = self.sock.read(4)
+                resp = self.sock.read(self._recv_len())
                 # print(resp)
-                assert resp[1] == pkt[2] and resp[2] == pkt[3]
-                if resp[3] == 0x80:
-                    raise MQTTException(resp[3])
+                assert resp[0] == pkt[2] and resp[1] == pkt[3]
+                if resp[-1] >= 0x80:
+                    raise MQTTException(resp[-1])
                 return
 
     # Wait for a single incoming MQTT message and process it.
@@ -199,6 +358,10 @@ class MQTTClient:
             pid = self.sock.read(2)
             pid = pid[0] << 8 | pid[1]
             sz -= 2
+        if self.mqtt5:
+            n = self._recv_len()
+            self.sock.read(n)
+            sz -= len(_varint(n)) + n
         msg = self.sock.read(sz)
         self.cb(topic, msg)
         if op & 6 == 2: